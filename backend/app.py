@@ -4,19 +4,27 @@ from flask_sqlalchemy import SQLAlchemy
 import os
 import datetime
 import uuid
-from openai import OpenAI
+from openai import OpenAI, NotFoundError
 from dotenv import load_dotenv
 import pandas as pd
 import json
 from flask_mail import Mail, Message as MailMessage
 import sqlite3
+import gzip
 from trello_integration import TrelloIntegration
+from run_lifecycle import RunLifecycleManager
+
+# Brotli is optional, responses fall back to gzip if it is not installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # Load environment variables from .env file
 load_dotenv()
 # Initialize Flask app
 app = Flask(__name__)
-CORS(app)  # Enable CORS for all routes
+CORS(app, expose_headers=["ETag", "Last-Modified"])  # Enable CORS for all routes, let the client read cache validators
 
 # Get the OpenAI API key from environment variables and set up OpenAI client
 api_key = os.getenv('OPENAI_API_KEY')
@@ -66,6 +74,63 @@ def mark_conversation_as_saved(conversation_id, trello_card_id):
 # Initialize database
 with app.app_context():
     db.create_all()
+    # Indexes for the per-conversation lookups and the reaper sweeps (create_all doesn't add them to an existing table)
+    db.session.execute(db.text(
+        "CREATE INDEX IF NOT EXISTS ix_message_conversation_id ON message (conversation_id, id)"
+    ))
+    db.session.execute(db.text(
+        "CREATE INDEX IF NOT EXISTS ix_message_thread_timestamp ON message (openai_thread_id, timestamp)"
+    ))
+    db.session.execute(db.text(
+        "CREATE INDEX IF NOT EXISTS ix_message_timestamp ON message (timestamp)"
+    ))
+    db.session.commit()
+
+# Responses smaller than this are sent uncompressed
+COMPRESSION_MIN_SIZE = 1024
+
+def is_not_modified(etag, last_modified=None):
+    """Check the request's conditional headers against the current ETag / Last-Modified"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified and request.if_modified_since:
+        # HTTP dates have second precision, timestamps are stored as naive UTC
+        last_modified = last_modified.replace(microsecond=0, tzinfo=datetime.timezone.utc)
+        return last_modified <= request.if_modified_since
+    return False
+
+def not_modified_response(etag, last_modified=None):
+    """Create an empty 304 response carrying the cache validators"""
+    response = app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified.replace(tzinfo=datetime.timezone.utc)
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Compress large JSON responses with brotli or gzip, depending on what the client accepts"""
+    response.vary.add("Accept-Encoding")
+
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or "Content-Encoding" in response.headers
+            or response.mimetype != "application/json"):
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_SIZE:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli and accepted["br"]:
+        response.set_data(brotli.compress(data))
+        response.headers["Content-Encoding"] = "br"
+    elif accepted["gzip"]:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers["Content-Encoding"] = "gzip"
+
+    return response
 
 # Create a vector store to upload and store all files
 vector_store = client.vector_stores.create(        # Create vector store
@@ -159,6 +224,39 @@ app.config['MAIL_USE_TLS'] = False
 app.config['MAIL_USE_SSL'] = True
 mail = Mail(app)
 
+# Initialize run lifecycle management for Assistant runs
+run_manager = RunLifecycleManager(client)
+
+def get_recent_threads(since):
+    """Get the OpenAI thread ids of conversations with messages since the given datetime"""
+    with app.app_context():
+        threads = db.session.query(Message.openai_thread_id)\
+                        .filter(Message.timestamp >= since)\
+                        .filter(Message.openai_thread_id.isnot(None))\
+                        .distinct().all()
+        return [thread[0] for thread in threads]
+
+def delete_expired_threads(cutoff, manager):
+    """Delete OpenAI threads whose last message is older than the cutoff"""
+    with app.app_context():
+        expired = db.session.query(Message.openai_thread_id)\
+                        .filter(Message.openai_thread_id.isnot(None))\
+                        .group_by(Message.openai_thread_id)\
+                        .having(db.func.max(Message.timestamp) < cutoff).all()
+
+        for (thread_id,) in expired:
+            if manager.delete_thread(thread_id):
+                # Keep the local history but drop the reference, so a follow-up gets a new thread
+                Message.query.filter_by(openai_thread_id=thread_id)\
+                       .update({"openai_thread_id": None})
+                db.session.commit()
+                print(f"Deleted expired thread {thread_id}")
+
+# Periodically cancel orphaned runs and delete threads past retention. With the debug
+# reloader this module is loaded by a parent and a child process, only the child serves requests
+if os.environ.get("WERKZEUG_RUN_MAIN") == "true" or not (__name__ == '__main__' or app.debug):
+    run_manager.start_reaper(get_recent_threads, delete_expired_threads)
+
 def get_db_connection():
     conn = sqlite3.connect('messages.db')
     conn.row_factory = sqlite3.Row
@@ -185,15 +283,30 @@ def chat():
             thread = client.beta.threads.create()
             thread_id = thread.id
         else:
-            # Find existing thread_id from database
-            existing_msg = Message.query.filter_by(conversation_id=conversation_id).first()
-            if existing_msg and existing_msg.openai_thread_id:
+            # Find existing thread_id from database (latest one, threads past retention are cleared)
+            existing_msg = Message.query.filter_by(conversation_id=conversation_id)\
+                                  .filter(Message.openai_thread_id.isnot(None))\
+                                  .order_by(Message.timestamp.desc()).first()
+            if existing_msg:
                 thread_id = existing_msg.openai_thread_id
-            else:
+                # Free the thread first, new messages are rejected while a run is active on it
+                try:
+                    thread_free = run_manager.cancel_active_runs(thread_id)
+                except NotFoundError:
+                    # The thread no longer exists on the OpenAI side, drop the reference and start a new one
+                    Message.query.filter_by(openai_thread_id=thread_id)\
+                           .update({"openai_thread_id": None})
+                    db.session.commit()
+                    thread_id = None
+                    thread_free = True
+                if not thread_free:
+                    return jsonify({"error": "The previous message is still being processed, please try again"}), 409
+
+            if not thread_id:
                 # Create a new thread if we can't find one
                 thread = client.beta.threads.create()
                 thread_id = thread.id
-        
+
         # Store user message in database
         new_user_message = Message(
             conversation_id=conversation_id,
@@ -212,24 +325,22 @@ def chat():
         )
 
         # Run the assistant on the thread
-        run = client.beta.threads.runs.create(
-            thread_id=thread_id,
+        run = run_manager.start_run(
+            thread_id,
             assistant_id=assistant.id,
-            additional_instructions=None,             
-        )   
+            additional_instructions=None,
+        )
 
-        # Wait for the run to complete
-        while run.status in ["queued", "in_progress"]:
-            run = client.beta.threads.runs.retrieve(
-                thread_id=thread_id,
-                run_id=run.id
-            )
+        # Wait for the run to complete (cancelled if it exceeds the run timeout)
+        run = run_manager.wait_for_run(thread_id, run)
 
         # If run requires action, handle the tool call
         if run.status == "requires_action":
             tool_calls = run.required_action.submit_tool_outputs.tool_calls
+            # No tool outputs are submitted, so cancel the run to free the thread for the next message
+            run_manager.cancel_run(thread_id, run.id)
             if tool_calls and tool_calls[0].function.name == "open_real_person_dialog":
-                # Don't submit any tool output, just tell the frontend to open the dialog
+                # Tell the frontend to open the dialog
                 return jsonify({
                     "action": "open_real_person_dialog",
                     "conversation_id": conversation_id
@@ -281,10 +392,30 @@ def get_messages():
 
 @app.route('/api/conversations/<conversation_id>', methods=['GET'])
 def get_conversation(conversation_id):
-    """Fetch all messages in a specific conversation"""
-    messages = Message.query.filter_by(conversation_id=conversation_id)\
-                          .order_by(Message.timestamp).all()
-    return jsonify([
+    """Fetch the messages in a specific conversation, optionally only those after the message id `since`"""
+    since = request.args.get('since')
+    if since is not None and not since.isdecimal():
+        return jsonify({"error": "'since' must be a message id"}), 400
+
+    # Derive the validators from the last message only, so unchanged conversations are never serialized
+    last_message = Message.query.filter_by(conversation_id=conversation_id)\
+                          .order_by(Message.id.desc()).first()
+    if last_message:
+        etag = f"{conversation_id}-{last_message.id}-{last_message.timestamp.timestamp()}"
+        last_modified = last_message.timestamp
+    else:
+        etag = f"{conversation_id}-0"
+        last_modified = None
+
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+
+    query = Message.query.filter_by(conversation_id=conversation_id)
+    if since is not None:
+        query = query.filter(Message.id > int(since))
+    messages = query.order_by(Message.id).all()
+
+    response = jsonify([
         {
             "id": msg.id, 
             "role": msg.role, 
@@ -293,6 +424,11 @@ def get_conversation(conversation_id):
         }
         for msg in messages
     ])
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified.replace(tzinfo=datetime.timezone.utc)
+    response.cache_control.no_cache = True  # always revalidate, the ETag keeps that cheap
+    return response
 
 
 # Initialize Trello integration
@@ -476,11 +612,21 @@ def escalate():
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Simple endpoint to verify the API is running"""
-    return jsonify({
-        "status": "ok",
-        "version": "0.0.1",
-        "timestamp": datetime.datetime.now().isoformat()
+    # No per-request timestamp in the body, so the ETag describes the whole representation
+    status = "ok"
+    version = "0.0.1"
+    etag = f"health-{status}-{version}"
+
+    if is_not_modified(etag):
+        return not_modified_response(etag)
+
+    response = jsonify({
+        "status": status,
+        "version": version
     })
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
 
 
 # run local server
@@ -0,0 +1,257 @@
+import os
+import time
+import threading
+from datetime import datetime, timedelta
+from openai import NotFoundError
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Run states in which a run still blocks new messages on its thread
+ACTIVE_RUN_STATUSES = ["queued", "in_progress", "requires_action", "cancelling"]
+# Active states in which a run is still being worked on (and may be polled by another request)
+PROCESSING_RUN_STATUSES = ["queued", "in_progress"]
+
+
+class RunLifecycleManager:
+    """
+    Class to track active Assistant runs per thread and cancel runs that are
+    abandoned, timed out or left waiting on requires_action.
+    """
+
+    def __init__(self, client):
+        """Initialize the manager with the OpenAI client and timeouts from environment variables."""
+        self.client = client
+        self.run_timeout = int(os.getenv('RUN_TIMEOUT_SECONDS', 60))
+        self.poll_interval = float(os.getenv('RUN_POLL_INTERVAL_SECONDS', 0.5))
+        self.busy_wait = int(os.getenv('RUN_BUSY_WAIT_SECONDS', 15))
+        self.reaper_interval = int(os.getenv('RUN_REAPER_INTERVAL_SECONDS', 60))
+        self.retention_sweep_interval = int(os.getenv('RETENTION_SWEEP_INTERVAL_HOURS', 24)) * 3600
+        self.thread_retention_days = int(os.getenv('THREAD_RETENTION_DAYS', 30))
+
+        # thread_id -> run_id for runs polled by a request of this process
+        self._active_runs = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def start_run(self, thread_id, **kwargs):
+        """
+        Create a new run on a thread and track it as the thread's active run.
+        Call cancel_active_runs before adding a message so the thread is free.
+
+        Args:
+            thread_id (str): The OpenAI thread ID
+            **kwargs: Arguments passed through to runs.create
+
+        Returns:
+            Run: The newly created run
+        """
+        run = self.client.beta.threads.runs.create(thread_id=thread_id, **kwargs)
+        self._track(thread_id, run.id)
+        return run
+
+    def wait_for_run(self, thread_id, run):
+        """
+        Poll a run until it leaves the queued/in_progress states or the timeout is hit.
+        Runs that exceed the timeout are cancelled.
+
+        Args:
+            thread_id (str): The OpenAI thread ID
+            run (Run): The run to wait for
+
+        Returns:
+            Run: The last retrieved state of the run
+        """
+        deadline = time.monotonic() + self.run_timeout
+
+        try:
+            while run.status in PROCESSING_RUN_STATUSES:
+                if time.monotonic() >= deadline:
+                    print(f"Run {run.id} on thread {thread_id} timed out after {self.run_timeout}s, cancelling")
+                    return self.cancel_run(thread_id, run.id) or run
+                time.sleep(self.poll_interval)
+                run = self.client.beta.threads.runs.retrieve(
+                    thread_id=thread_id,
+                    run_id=run.id
+                )
+        except Exception:
+            # Nobody polls the run anymore, leave it to the reaper or the next message
+            self._untrack(thread_id, run.id)
+            raise
+
+        # Terminal states no longer need tracking; requires_action stays tracked
+        # until the caller either submits tool outputs or cancels it
+        if run.status != "requires_action":
+            self._untrack(thread_id, run.id)
+        return run
+
+    def cancel_run(self, thread_id, run_id):
+        """
+        Cancel a single run and stop tracking it.
+
+        Args:
+            thread_id (str): The OpenAI thread ID
+            run_id (str): The run ID to cancel
+
+        Returns:
+            Run: The cancelled run if successful, None otherwise
+        """
+        self._untrack(thread_id, run_id)
+        try:
+            return self.client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        except Exception as e:
+            # The run may already have finished between the last poll and the cancel
+            print(f"Error cancelling run {run_id} on thread {thread_id}: {e}")
+            return None
+
+    def cancel_active_runs(self, thread_id):
+        """
+        Free a thread before a new message is added to it. Abandoned runs (waiting
+        on requires_action or older than the run timeout) are cancelled, runs that
+        are still being processed are waited for, backing off up to the busy wait.
+        API errors (e.g. NotFoundError for a deleted thread) are raised to the caller.
+
+        Args:
+            thread_id (str): The OpenAI thread ID
+
+        Returns:
+            bool: True if the thread is free, False if runs still block it
+        """
+        deadline = time.monotonic() + self.busy_wait
+        interval = self.poll_interval
+        cancelled = []
+
+        while True:
+            blocking = self._cancel_abandoned_runs(thread_id, cancelled)
+
+            if not blocking:
+                return True
+            if time.monotonic() >= deadline:
+                print(f"Thread {thread_id} still blocked by runs {blocking}")
+                return False
+            time.sleep(interval)
+            interval = min(interval * 2, 4)
+
+    def reap_orphaned_runs(self, thread_ids):
+        """
+        Cancel abandoned runs on the given threads, e.g. runs left behind by a
+        crashed worker, a failed poll or a previous process. Healthy runs are spared.
+
+        Args:
+            thread_ids (list): OpenAI thread IDs to check
+
+        Returns:
+            int: Number of runs a cancel was issued for
+        """
+        cancelled = []
+        for thread_id in thread_ids:
+            try:
+                self._cancel_abandoned_runs(thread_id, cancelled)
+            except Exception as e:
+                print(f"Error listing runs for thread {thread_id}: {e}")
+
+        return len(cancelled)
+
+    def delete_thread(self, thread_id):
+        """
+        Cancel remaining runs on a thread and delete it on the OpenAI side.
+
+        Args:
+            thread_id (str): The OpenAI thread ID
+
+        Returns:
+            bool: True if the thread was deleted or no longer exists, False otherwise
+        """
+        with self._lock:
+            tracked_run_id = self._active_runs.pop(thread_id, None)
+        if tracked_run_id:
+            self.cancel_run(thread_id, tracked_run_id)
+
+        try:
+            self.client.beta.threads.delete(thread_id=thread_id)
+            return True
+        except NotFoundError:
+            # Already deleted, e.g. by an earlier sweep or by hand
+            return True
+        except Exception as e:
+            print(f"Error deleting thread {thread_id}: {e}")
+            return False
+
+    def start_reaper(self, recent_threads_callback, expired_threads_callback):
+        """
+        Start a background thread that periodically cancels orphaned runs on recently
+        active threads and, on a much longer interval, deletes threads past retention.
+
+        Args:
+            recent_threads_callback (callable): Called with a datetime, returns the
+                thread IDs of conversations with messages since then
+            expired_threads_callback (callable): Called with the retention cutoff
+                datetime and this manager; responsible for deleting expired threads
+        """
+        if self._reaper is not None:
+            return
+
+        # An orphaned run is abandoned run_timeout after its message was stored,
+        # this window guarantees at least one reaper pass sees it afterwards
+        orphan_window = timedelta(seconds=self.run_timeout + 2 * self.reaper_interval)
+
+        def loop():
+            next_retention_sweep = time.monotonic()
+            while True:
+                time.sleep(self.reaper_interval)
+                try:
+                    thread_ids = recent_threads_callback(datetime.utcnow() - orphan_window)
+                    self.reap_orphaned_runs(thread_ids)
+                except Exception as e:
+                    print(f"Error reaping orphaned runs: {e}")
+
+                if time.monotonic() >= next_retention_sweep:
+                    next_retention_sweep = time.monotonic() + self.retention_sweep_interval
+                    try:
+                        cutoff = datetime.utcnow() - timedelta(days=self.thread_retention_days)
+                        expired_threads_callback(cutoff, self)
+                    except Exception as e:
+                        print(f"Error deleting expired threads: {e}")
+
+        self._reaper = threading.Thread(target=loop, name="run-reaper", daemon=True)
+        self._reaper.start()
+
+    def _cancel_abandoned_runs(self, thread_id, cancelled):
+        """
+        Issue a cancel for every abandoned run on a thread that wasn't cancelled yet.
+
+        Args:
+            thread_id (str): The OpenAI thread ID
+            cancelled (list): IDs of runs already cancelled, extended in place
+
+        Returns:
+            list: IDs of runs that still block the thread
+        """
+        runs = self.client.beta.threads.runs.list(thread_id=thread_id, limit=10)
+        abandoned_before = time.time() - self.run_timeout
+        blocking = []
+
+        for run in runs.data:
+            if run.status not in ACTIVE_RUN_STATUSES:
+                continue
+            blocking.append(run.id)
+            if run.id in cancelled or run.status == "cancelling":
+                continue
+            if run.status == "requires_action" or run.created_at < abandoned_before:
+                print(f"Cancelling abandoned run {run.id} ({run.status}) on thread {thread_id}")
+                self.cancel_run(thread_id, run.id)
+                cancelled.append(run.id)
+
+        return blocking
+
+    def _track(self, thread_id, run_id):
+        """Remember a run as the active run of its thread."""
+        with self._lock:
+            self._active_runs[thread_id] = run_id
+
+    def _untrack(self, thread_id, run_id):
+        """Forget a run, unless a newer run has replaced it in the meantime."""
+        with self._lock:
+            if self._active_runs.get(thread_id) == run_id:
+                del self._active_runs[thread_id]